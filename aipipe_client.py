@@ -1,15 +1,22 @@
 import os
+import asyncio
+import logging
+from pathlib import Path
 import httpx
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv()
 AIPIPE_API_KEY = os.getenv("AIPIPE_API_KEY")
 
-AIPIPE_CHAT_URL = "https://aipipe.org/openrouter/v1/chat/completions"
+AIPIPE_BASE_URL = "https://aipipe.org"
+AIPIPE_CHAT_URL = f"{AIPIPE_BASE_URL}/openrouter/v1/chat/completions"
 
+logger = logging.getLogger("tds")
+_http_version_logged = False
 
-async def call_aipipe(prompt: str, model="openai/gpt-4.1-nano"):
-    """Call AI Pipe to generate a response for a simple prompt."""
+
+def _chat_request(prompt, model):
     headers = {
         "Authorization": f"Bearer {AIPIPE_API_KEY}",
         "Content-Type": "application/json",
@@ -18,9 +25,57 @@ async def call_aipipe(prompt: str, model="openai/gpt-4.1-nano"):
         "model": model,
         "messages": [{"role": "user", "content": prompt}],
     }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            AIPIPE_CHAT_URL, headers=headers, json=json_data, timeout=60.0
+    return headers, json_data
+
+
+def _log_http_version(response):
+    # Once per worker is enough to confirm HTTP/2 was negotiated
+    global _http_version_logged
+    if not _http_version_logged:
+        _http_version_logged = True
+        logger.info("AI Pipe connection uses %s", response.http_version)
+
+
+def _check_status(response):
+    if response.status_code >= 400:
+        raise httpx.HTTPStatusError(
+            f"AI Pipe returned {response.status_code}",
+            request=response.request,
+            response=response,
         )
-    response.raise_for_status()
-    return response.json()
+
+
+async def call_aipipe(
+    prompt: str, client: httpx.AsyncClient, model="openai/gpt-4.1-nano"
+):
+    """Call AI Pipe to generate a response for a simple prompt.
+
+    Uses the shared pooled client so the TLS connection is kept alive between calls.
+    """
+    headers, json_data = _chat_request(prompt, model)
+    response = await client.post(AIPIPE_CHAT_URL, headers=headers, json=json_data)
+    _log_http_version(response)
+    _check_status(response)
+    return orjson.loads(response.content)
+
+
+async def call_aipipe_stream(
+    prompt: str, out_path, client: httpx.AsyncClient, model="openai/gpt-4.1-nano"
+):
+    """Call AI Pipe and write the generated message content straight to out_path.
+
+    The body is streamed into a single buffer and parsed with orjson, so the
+    completion isn't held as both bytes and text. Returns the message content.
+    """
+    headers, json_data = _chat_request(prompt, model)
+    buf = bytearray()
+    async with client.stream(
+        "POST", AIPIPE_CHAT_URL, headers=headers, json=json_data
+    ) as response:
+        _log_http_version(response)
+        _check_status(response)
+        async for chunk in response.aiter_bytes():
+            buf.extend(chunk)
+    content = orjson.loads(buf)["choices"][0]["message"]["content"]
+    await asyncio.to_thread(Path(out_path).write_bytes, content.encode("utf-8"))
+    return content
@@ -2,19 +2,76 @@ from fastapi import FastAPI, BackgroundTasks, HTTPException
 from pydantic import BaseModel
 from typing import List, Dict, Optional
 import os
+import sys
 import time
-import tempfile
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 import asyncio
-from aipipe_client import call_aipipe
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import httpx
+from aipipe_client import call_aipipe, call_aipipe_stream
 import base64
-import tempfile
 from utils import *
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="TDS LLM Deployment", version="1.0.0")
+logger = logging.getLogger("tds")
+logger.setLevel(logging.INFO)
+
+
+def _start_logging():
+    """Queue log records on the event loop and write them from a listener thread.
+
+    Runs from the lifespan rather than at import: spawn workers import this file
+    twice (as __mp_main__ and as main), which would attach an undrained handler.
+    """
+    if any(isinstance(h, QueueHandler) for h in logger.handlers):
+        return None
+    log_queue = queue.SimpleQueue()
+    handler = QueueHandler(log_queue)
+    listener = QueueListener(log_queue, logging.StreamHandler())
+    logger.addHandler(handler)
+    logger.propagate = False
+    listener.start()
+    return handler, listener
+
+
+def _stop_logging(started):
+    if started is None:
+        return
+    handler, listener = started
+    logger.removeHandler(handler)
+    logger.propagate = True
+    listener.stop()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled client per worker keeps connections to aipipe/GitHub alive across
+    # tasks, and HTTP/2 lets concurrent calls to the same host share one connection
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        limits=httpx.Limits(
+            max_keepalive_connections=32, max_connections=64, keepalive_expiry=30.0
+        ),
+    )
+    logging_started = _start_logging()
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        _stop_logging(logging_started)
+
+
+app = FastAPI(
+    title="TDS LLM Deployment",
+    version="1.0.0",
+    lifespan=lifespan,
+)
 
 # Get environment variables
 STUDENT_SECRET = os.getenv("STUDENT_SECRET")
@@ -22,6 +79,40 @@ STUDENT_EMAIL = os.getenv("STUDENT_EMAIL")
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 GITHUB_USERNAME = os.getenv("GITHUB_USERNAME")
 AIPIPE_API_KEY = os.getenv("AIPIPE_API_KEY")
+MAX_INFLIGHT_TASKS = int(os.getenv("MAX_INFLIGHT_TASKS", "4"))
+
+# Caps concurrent background tasks so bursts can't exhaust fds or the client pool
+_task_sem = asyncio.Semaphore(MAX_INFLIGHT_TASKS)
+_tasks_waiting = 0
+
+# Round 1 prompt; only brief, checks and attachment names vary per task
+_INITIAL_TEMPLATE = (
+    "You are an expert frontend developer.\n"
+    "Given these requirements:\n\n{brief}\n\n"
+    "The following checks will be performed by the evaluator:\n"
+    "{checks}\n\n"
+    "You may be given file attachments, refer to them by the names below: "
+    "{attachments}\n\n"
+    "Please output a single complete HTML file with embedded CSS and JS as required.\n"
+    "The HTML output must pass all checks. "
+    "Start your output directly with <!DOCTYPE html> (no code fences)."
+)
+
+# Round 2 prompt; wraps the currently deployed index.html with the new brief
+_REVISION_TEMPLATE = (
+    "You are updating a previously deployed static website. "
+    "Below is the current code for the website (index.html):\n\n"
+    "----- OLD CODE START -----\n"
+    "{existing_code}\n"
+    "----- OLD CODE END -----\n\n"
+    "Your new instructions are:\n"
+    "{brief}\n\n"
+    "You must update the code to implement these new requirements "
+    "while preserving all existing original features unless a change is requested. "
+    "The following code checks will be used to automatically test your solution:\n"
+    "{checks}\n\n"
+    "Return ONLY the complete updated HTML file, starting with <!DOCTYPE html>."
+)
 
 
 # Pydantic models for request/response
@@ -42,19 +133,35 @@ class TaskRequest(BaseModel):
     attachments: List[Attachment] = []
 
 
+# Declared return types let FastAPI serialize responses directly with pydantic-core
+class HealthResponse(BaseModel):
+    message: str
+    student_email: Optional[str]
+    status: str
+
+
+class TaskAccepted(BaseModel):
+    status: str
+    message: str
+    task: str
+    round: int
+
+
 # Root endpoint for health check
 @app.get("/")
-async def root():
-    return {
-        "message": "TDS LLM Deployment API is running!",
-        "student_email": STUDENT_EMAIL,
-        "status": "ready",
-    }
+async def root() -> HealthResponse:
+    return HealthResponse(
+        message="TDS LLM Deployment API is running!",
+        student_email=STUDENT_EMAIL,
+        status="ready",
+    )
 
 
 # Main endpoint that will receive tasks
 @app.post("/api-endpoint")
-async def receive_task(request: TaskRequest, background_tasks: BackgroundTasks):
+async def receive_task(
+    request: TaskRequest, background_tasks: BackgroundTasks
+) -> TaskAccepted:
     """
     Main endpoint that receives task requests from instructors.
     CRITICAL: Must return HTTP 200 within seconds.
@@ -64,213 +171,185 @@ async def receive_task(request: TaskRequest, background_tasks: BackgroundTasks):
     if request.secret != STUDENT_SECRET:
         raise HTTPException(status_code=401, detail="Invalid secret")
 
-    print(f"✅ Received valid task: {request.task} (Round {request.round})")
+    logger.info("✅ Received valid task: %s (Round %s)", request.task, request.round)
 
     # Step 2: Add to background processing (we'll implement this next)
-    background_tasks.add_task(process_task_background, request.dict())
+    background_tasks.add_task(process_task_background, request)
 
     # Step 3: Return 200 immediately
-    return {
-        "status": "accepted",
-        "message": "Task received and processing started",
-        "task": request.task,
-        "round": request.round,
+    return TaskAccepted(
+        status="accepted",
+        message="Task received and processing started",
+        task=request.task,
+        round=request.round,
+    )
+
+
+def build_prompt(task: TaskRequest, checks_md, existing_code=None):
+    """Build the Round 1 prompt, or the revision prompt when existing code is given."""
+    fields = {"brief": task.brief, "checks": checks_md}
+    if existing_code is None:
+        fields["attachments"] = ", ".join(a.name for a in task.attachments)
+        return _INITIAL_TEMPLATE.format_map(fields)
+    fields["existing_code"] = existing_code
+    return _REVISION_TEMPLATE.format_map(fields)
+
+
+async def publish_and_notify(task: TaskRequest, repo_url, commit_sha, token, client):
+    """Enable Pages for the pushed commit and notify the evaluator."""
+    repo_name = task.task
+
+    # Enable GitHub Pages (already enabled in Round 2, but harmless to re-call)
+    pages_url = f"https://{GITHUB_USERNAME}.github.io/{repo_name}/"
+    enabled = await enable_github_pages(repo_name, token, client, branch="main")
+    if enabled:
+        logger.info("🎉 Your app should soon be live at %s", pages_url)
+    else:
+        logger.warning("❗Caution: Pages not enabled, check error above.")
+
+    payload = {
+        "email": task.email,
+        "task": repo_name,
+        "round": task.round,
+        "nonce": task.nonce,
+        "repo_url": repo_url,
+        "commit_sha": commit_sha,
+        "pages_url": pages_url,
     }
+    logger.info("📦 Notifying evaluator with payload: %s", payload)
+    logger.info("📨 Sending to: %s", task.evaluation_url)
 
-
-async def process_task_background(task_data):
-    token = os.getenv("GITHUB_TOKEN")
-    round_number = task_data["round"]
-    repo_name = task_data["task"]  # Use the same repo name for both rounds
-    username = GITHUB_USERNAME
-
-    if round_number == 2:
-        print("🔁 Detected Round 2 (Revision) request!")
+    success = await notify_evaluator(task.evaluation_url, payload, client)
+    if success:
+        logger.info("🎯 Evaluation API notified successfully!")
+    else:
+        logger.error("❌ Failed to notify evaluator after retries.")
+
+
+async def process_task_background(task: TaskRequest):
+    global _tasks_waiting
+    if _task_sem.locked():
+        # Every slot is busy, so this task queues behind the ones in flight
+        _tasks_waiting += 1
+        logger.info(
+            "📥 Queued %s: %d waiting for one of %d slots",
+            task.task,
+            _tasks_waiting,
+            MAX_INFLIGHT_TASKS,
+        )
         try:
-            # Fetch existing code from GitHub
-            existing_code = await fetch_github_file(
+            await _task_sem.acquire()
+        finally:
+            _tasks_waiting -= 1
+    else:
+        await _task_sem.acquire()
+    try:
+        await run_task(task)
+    finally:
+        _task_sem.release()
+
+
+async def run_task(task: TaskRequest):
+    token = GITHUB_TOKEN
+    repo_name = task.task  # Use the same repo name for both rounds
+    repo_url = f"https://github.com/{GITHUB_USERNAME}/{repo_name}"
+    client = app.state.http
+    # Shared by the prompt and the README
+    checks_md = "\n".join("- " + c for c in task.checks)
+
+    try:
+        if task.round == 2:
+            logger.info("🔁 Detected Round 2 (Revision) request!")
+            existing_code, file_sha = await fetch_github_file(
                 repo_name=repo_name,
                 filename="index.html",
                 token=token,
+                client=client,
                 branch="main",
-                username=username,
+                username=GITHUB_USERNAME,
             )
-            print("✅ Existing index.html fetched from GitHub repo.")
-
-            # Compose the revision prompt
-            new_brief = task_data["brief"]
-            checks = task_data["checks"]
-
-            revision_prompt = (
-                "You are updating a previously deployed static website. "
-                "Below is the current code for the website (index.html):\n\n"
-                "----- OLD CODE START -----\n"
-                f"{existing_code}\n"
-                "----- OLD CODE END -----\n\n"
-                "Your new instructions are:\n"
-                f"{new_brief}\n\n"
-                "You must update the code to implement these new requirements "
-                "while preserving all existing original features unless a change is requested. "
-                "The following code checks will be used to automatically test your solution:\n"
-                f"{chr(10).join('- ' + c for c in checks)}\n\n"
-                "Return ONLY the complete updated HTML file, starting with <!DOCTYPE html>."
+            logger.info("✅ Existing index.html fetched from GitHub repo.")
+
+            prompt = build_prompt(task, checks_md, existing_code)
+            logger.info("📝 Revision prompt created, sending to LLM...")
+            response = await call_aipipe(prompt, client)
+            llm_message = response["choices"][0]["message"]["content"]
+            logger.info("✅ Received revised HTML from LLM.")
+
+            # Only index.html changes, so update it in place instead of clone + push
+            commit_sha = await put_github_file(
+                repo_name,
+                "index.html",
+                llm_message,
+                file_sha,
+                "Automated commit",
+                token,
+                client,
+                username=GITHUB_USERNAME,
             )
-            print("📝 Revision prompt created, sending to LLM...")
-
-            # Call LLM with revision prompt
-            revision_response = await call_aipipe(revision_prompt)
-            revised_html = revision_response["choices"][0]["message"]["content"]
-            print("✅ Received revised HTML from LLM.")
-
-            # Clone the repo (recommended to avoid git history issues)
-
-            with tempfile.TemporaryDirectory() as tempdir:
-                clone_repo(repo_name, token, tempdir, username=username)
-                # Overwrite index.html with revised content
-                filename = os.path.join(tempdir, "index.html")
-                with open(filename, "w", encoding="utf-8") as f:
-                    f.write(revised_html)
-                print(f"✅ Revised index.html saved to {filename}")
-
-                # Optionally overwrite README.md/lic if needed; mostly, just commit index.html
-                commit_sha = push_to_github(
-                    f"https://github.com/{username}/{repo_name}", token, tempdir
+            logger.info("✅ Revised index.html committed. Commit SHA: %s", commit_sha)
+
+        else:
+            logger.info("🆕 Detected Round 1 (Initial build) request!")
+            logger.info("🔄 Processing task for: %s", task.task)
+
+            # Resent tasks share the repo's workdir and .git, possibly from another
+            # worker process, so build one at a time under a file lock
+            async with repo_lock(repo_name):
+                # Reuse the repo's working directory so its git objects survive reruns
+                workdir = repo_workdir(repo_name)
+
+                # The repo doesn't depend on the LLM output, so create it while the
+                # LLM runs; the generated HTML is streamed straight into index.html
+                filename = os.path.join(workdir, "index.html")
+                prompt = build_prompt(task, checks_md)
+                logger.info(
+                    "🔎 Calling AI Pipe with full prompt to generate app code..."
                 )
-                print(f"✅ Revision pushed. Commit SHA: {commit_sha}")
-
-                # Enable GitHub Pages (should already be enabled, but harmless to re-call)
-                enabled = enable_github_pages(repo_name, token, branch="main")
-                if enabled:
-                    pages_url = f"https://{username}.github.io/{repo_name}/"
-                    print(f"🎉 Your revised app should soon be live at {pages_url}")
-                else:
-                    print("❗Caution: Pages not enabled, check error above.")
-
-                # Notify evaluator
-                payload = {
-                    "email": task_data["email"],
-                    "task": repo_name,
-                    "round": round_number,
-                    "nonce": task_data["nonce"],
-                    "repo_url": f"https://github.com/{username}/{repo_name}",
-                    "commit_sha": commit_sha,
-                    "pages_url": pages_url,
-                }
-                print("📦 Notifying evaluator with payload:")
-                print(payload)
-                print("📨 Sending to:", task_data["evaluation_url"])
-
-                success = await notify_evaluator(task_data["evaluation_url"], payload)
-                print(
-                    "🎯 Evaluation API notified successfully!"
-                    if success
-                    else "❌ Failed to notify evaluator after retries."
+                logger.info("🚀 Creating GitHub repo: %s", repo_name)
+                llm_message, repo_url = await gather_or_cancel(
+                    call_aipipe_stream(prompt, filename, client),
+                    create_github_repo(repo_name, token, client, task.brief),
                 )
+                logger.info("✅ index.html saved to %s", filename)
+                logger.info("✅ GitHub repo created at: %s", repo_url)
 
-        except Exception as e:
-            print("❌ Round 2 revision error:", e)
-            return
+                # Save README.md and LICENSE
+                readme = generate_readme(task.brief, checks_md, task.task)
+                license_text = generate_mit_license(author=STUDENT_EMAIL or "anonymous")
+                await asyncio.gather(
+                    write_file(os.path.join(workdir, "README.md"), readme),
+                    write_file(os.path.join(workdir, "LICENSE"), license_text),
+                )
+                logger.info("✅ README.md and LICENSE saved")
 
-    else:
-        print("🆕 Detected Round 1 (Initial build) request!")
-
-        print(f"🔄 Processing task for: {task_data['task']}")
-        brief = task_data["brief"]
-        checks = task_data["checks"]
-
-        # Compose the prompt for AI Pipe
-        prompt = (
-            f"""You are an expert frontend developer. 
-    Given these requirements:\n\n{brief}\n\n"""
-            f"""The following checks will be performed by the evaluator: 
-    {chr(10).join("- " + c for c in checks)}\n\n"""
-            f"""You may be given file attachments, refer to them by the names below: """
-            f"""{[a["name"] for a in task_data.get("attachments", [])]}\n\n"""
-            f"""Please output a single complete HTML file with embedded CSS and JS as required. 
-    The HTML output must pass all checks. Start your output directly with <!DOCTYPE html> (no code fences)."""
-        )
-        print("🔎 Calling AI Pipe with full prompt to generate app code...")
-        response = await call_aipipe(prompt)
+                logger.info("🚀 Pushing files to GitHub repo...")
+                commit_sha = await push_to_github(repo_url, token, workdir)
+                logger.info("✅ Files pushed to repo. Commit SHA: %s", commit_sha)
 
-        try:
-            llm_message = response["choices"][0]["message"]["content"]
-            # 1. Create a temp directory for repo files
-            with tempfile.TemporaryDirectory() as tempdir:
-                # Save index.html
-                filename = os.path.join(tempdir, "index.html")
-                with open(filename, "w", encoding="utf-8") as f:
-                    f.write(llm_message)
-                print(f"✅ index.html saved to {filename}")
+        await publish_and_notify(task, repo_url, commit_sha, token, client)
+        logger.info("🎉 SUCCESS: App deployed at %s", repo_url)
 
-                # Save README.md and LICENSE
-                readme = generate_readme(brief, checks, task_data["task"])
-                license_text = generate_mit_license(author=STUDENT_EMAIL or "anonymous")
-                with open(
-                    os.path.join(tempdir, "README.md"), "w", encoding="utf-8"
-                ) as f:
-                    f.write(readme)
-                print(f"✅ README.md saved")
-                with open(os.path.join(tempdir, "LICENSE"), "w", encoding="utf-8") as f:
-                    f.write(license_text)
-                print(f"✅ LICENSE saved")
-
-                # 🚀 2. Create the repo via GitHub API
-                repo_name = task_data["task"]
-                token = os.getenv("GITHUB_TOKEN")
-                description = brief
-                print(f"🚀 Creating GitHub repo: {repo_name}")
-                repo_url = create_github_repo(repo_name, token, description)
-                print(f"✅ GitHub repo created at: {repo_url}")
-
-                # 🚀 3. Push files to GitHub repo
-                print(f"🚀 Pushing files to GitHub repo...")
-                try:
-                    commit_sha = push_to_github(repo_url, token, tempdir)
-                    print(f"✅ Files pushed to repo. Commit SHA: {commit_sha}")
-                    enabled = enable_github_pages(repo_name, token, branch="main")
-                    if enabled:
-                        pages_url = f"https://{GITHUB_USERNAME}.github.io/{repo_name}/"
-                        print(f"🎉 Your app should soon be live at {pages_url}")
-                    else:
-                        print("❗Caution: Pages not enabled, check error above.")
-                    payload = {
-                        "email": task_data["email"],
-                        "task": repo_name,
-                        "round": task_data["round"],
-                        "nonce": task_data["nonce"],
-                        "repo_url": repo_url,
-                        "commit_sha": commit_sha,
-                        "pages_url": pages_url,
-                    }
-                    print("📦 Notifying evaluator with payload:")
-                    print(payload)
-                    print("📨 Sending to:", task_data["evaluation_url"])
-
-                    success = await notify_evaluator(
-                        task_data["evaluation_url"], payload
-                    )
-                    if success:
-                        print("🎯 Evaluation API notified successfully!")
-                    else:
-                        print("❌ Failed to notify evaluator after retries.")
-
-                except Exception as ex:
-                    print(f"❌ Git push error: {ex}")
-                    return  # Stop here if failed
-
-                # OPTIONAL: Print repo link for easy access
-                print(f"🎉 SUCCESS: App deployed at {repo_url}")
-
-            print(
-                "📝 LLM output (trimmed):",
-                llm_message[:400],
-                "..." if len(llm_message) > 400 else "",
-            )
-        except Exception as e:
-            print("LLM response parse error:", e, response)
+    except Exception as e:
+        logger.error("❌ Round %s error: %s", task.round, e)
+        return
+
+    logger.info(
+        "📝 LLM output (trimmed): %s %s",
+        llm_message[:400],
+        "..." if len(llm_message) > 400 else "",
+    )
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        # uvloop isn't available on Windows; fall back to the stdlib loop there
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "2")),
+    )
@@ -1,79 +1,222 @@
 from datetime import datetime
-import httpx
-import subprocess
 import os
 import asyncio
 import base64
+import logging
+import random
+import re
+import tempfile
+from contextlib import asynccontextmanager
+from pathlib import Path
+import orjson
+import pygit2
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+load_dotenv()
+# Read once at import; these don't change while the server is running
+_GITHUB_USERNAME = os.getenv("GITHUB_USERNAME")
+
+WORKDIR_ROOT = Path(tempfile.gettempdir()) / "tds"
+_REPO_NAME_RE = re.compile(r"[A-Za-z0-9._-]+")
+
+logger = logging.getLogger("tds")
+
+_CURRENT_YEAR = datetime.now().year
+_LICENSE_TEMPLATE = """MIT License
 
+Copyright (c) {year} {author}
 
-def clone_repo(repo_name, token, tempdir, username=None):
-    if username is None:
-        username = os.getenv("GITHUB_USERNAME")
-    repo_url = f"https://github.com/{username}/{repo_name}"
-    url_with_token = repo_url.replace("https://", f"https://{token}@")
-    subprocess.run(["git", "clone", url_with_token, tempdir], check=True)
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+async def gather_or_cancel(*aws):
+    """Like asyncio.gather, but cancels the others as soon as one of them fails."""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def _check_repo_name(repo_name):
+    # repo_name comes from the request; it must stay a single name under WORKDIR_ROOT
+    if not _REPO_NAME_RE.fullmatch(repo_name) or repo_name in (".", ".."):
+        raise ValueError(f"Invalid repo name: {repo_name!r}")
+    if not (WORKDIR_ROOT / repo_name).resolve().is_relative_to(WORKDIR_ROOT.resolve()):
+        raise ValueError(f"Repo workdir escapes {WORKDIR_ROOT}: {repo_name!r}")
+
+
+def repo_workdir(repo_name):
+    """Persistent working directory for a repo, reused across tasks and rounds."""
+    _check_repo_name(repo_name)
+    workdir = WORKDIR_ROOT / repo_name
+    workdir.mkdir(parents=True, exist_ok=True)
+    return workdir
+
+
+def _try_lock(f):
+    try:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def _unlock(f):
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    else:
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@asynccontextmanager
+async def repo_lock(repo_name):
+    """Exclusive lock on a repo's workdir, shared by every worker process.
+
+    The lock is polled rather than blocked on, so waiting never ties up a
+    thread and a cancelled task stops waiting immediately.
+    """
+    _check_repo_name(repo_name)
+    WORKDIR_ROOT.mkdir(parents=True, exist_ok=True)
+    with open(WORKDIR_ROOT / f"{repo_name}.lock", "a") as f:
+        while not _try_lock(f):
+            await asyncio.sleep(0.1)
+        try:
+            yield
+        finally:
+            _unlock(f)
 
 
-async def fetch_github_file(repo_name, filename, token, branch="main", username=None):
+async def fetch_github_file(
+    repo_name, filename, token, client, branch="main", username=None
+):
+    """Return the decoded file content and its blob SHA (needed to update it)."""
     if username is None:
-        username = os.getenv("GITHUB_USERNAME")
+        username = _GITHUB_USERNAME
     api_url = f"https://api.github.com/repos/{username}/{repo_name}/contents/{filename}?ref={branch}"
     headers = {"Authorization": f"token {token}"}
-    response = httpx.get(api_url, headers=headers)
+    response = await client.get(api_url, headers=headers)
     if response.status_code == 200:
-        content_base64 = response.json()["content"]
+        data = orjson.loads(response.content)
         # Remove line breaks for base64 decoding
-        content_base64_clean = "".join(content_base64.splitlines())
-        return base64.b64decode(content_base64_clean).decode("utf-8")
+        content_base64_clean = "".join(data["content"].splitlines())
+        return base64.b64decode(content_base64_clean).decode("utf-8"), data["sha"]
     else:
         raise Exception(
             f"Cannot fetch {filename} from {repo_name}: {response.status_code}, {response.text}"
         )
 
 
-async def notify_evaluator(evaluation_url, payload):
+async def put_github_file(
+    repo_name,
+    filename,
+    new_content,
+    sha,
+    message,
+    token,
+    client,
+    branch="main",
+    username=None,
+):
+    """Update a single file in place via the Contents API and return the commit SHA."""
+    if username is None:
+        username = _GITHUB_USERNAME
+    api_url = f"https://api.github.com/repos/{username}/{repo_name}/contents/{filename}"
+    headers = {
+        "Authorization": f"token {token}",
+        "Accept": "application/vnd.github.v3+json",
+    }
+    data = {
+        "message": message,
+        "content": base64.b64encode(new_content.encode("utf-8")).decode("ascii"),
+        "sha": sha,
+        "branch": branch,
+    }
+    response = await client.put(api_url, headers=headers, json=data)
+    if response.status_code in [200, 201]:
+        return orjson.loads(response.content)["commit"]["sha"]
+    raise Exception(
+        f"Cannot update {filename} in {repo_name}: {response.status_code}, {response.text}"
+    )
+
+
+async def notify_evaluator(evaluation_url, payload, client):
     headers = {"Content-Type": "application/json"}
+    body = orjson.dumps(payload)
     for attempt in range(5):
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    evaluation_url, json=payload, timeout=30, headers=headers
-                )
-            print("Response status code:", response.status_code)
-            print("Response text:", response.text)
+            response = await client.post(
+                evaluation_url, content=body, timeout=30, headers=headers
+            )
+            logger.info("Response status code: %s", response.status_code)
+            logger.info("Response text: %s", response.text)
             if response.status_code == 200:
-                print("✅ Notified evaluation server.")
+                logger.info("✅ Notified evaluation server.")
                 return True
-            else:
-                print(
-                    f"❗Evaluator returned status {response.status_code}: {response.text}"
-                )
+            logger.warning(
+                "❗Evaluator returned status %s: %s",
+                response.status_code,
+                response.text,
+            )
+            # Client errors won't succeed on retry, except timeouts and rate limits
+            status = response.status_code
+            if 400 <= status < 500 and status not in (408, 429):
+                return False
         except Exception as e:
-            print(f"❗Notify attempt {attempt + 1} failed: {e}")
-        await asyncio.sleep(2**attempt)
+            logger.warning("❗Notify attempt %s failed: %s", attempt + 1, e)
+        await asyncio.sleep(min(30, 2**attempt) + random.random() * 0.5)
     return False
 
 
-def enable_github_pages(repo_name, token, branch="main"):
+async def enable_github_pages(repo_name, token, client, branch="main"):
     """Enable GitHub Pages via API for the repo's main branch."""
-    api_url = (
-        f"https://api.github.com/repos/{os.getenv('GITHUB_USERNAME')}/{repo_name}/pages"
-    )
+    api_url = f"https://api.github.com/repos/{_GITHUB_USERNAME}/{repo_name}/pages"
     headers = {
         "Authorization": f"token {token}",
         "Accept": "application/vnd.github.v3+json",
     }
     data = {"source": {"branch": branch, "path": "/"}}
-    print(f"🚀 Enabling GitHub Pages at {api_url}")
-    response = httpx.post(api_url, headers=headers, json=data)
+    logger.info("🚀 Enabling GitHub Pages at %s", api_url)
+    response = await client.post(api_url, headers=headers, json=data)
     if response.status_code in [201, 204, 409]:  # 409 if already enabled
-        print("✅ GitHub Pages enabled or already active.")
+        logger.info("✅ GitHub Pages enabled or already active.")
         return True
-    print("❌ Failed to enable GitHub Pages:", response.status_code, response.text)
+    logger.error(
+        "❌ Failed to enable GitHub Pages: %s %s", response.status_code, response.text
+    )
     return False
 
 
-def create_github_repo(repo_name, token, description=""):
+async def create_github_repo(repo_name, token, client, description=""):
     """Create a new public GitHub repository via API."""
     api_url = "https://api.github.com/user/repos"
     headers = {
@@ -86,75 +229,65 @@ def create_github_repo(repo_name, token, description=""):
         "private": False,
         "auto_init": False,
     }
-    response = httpx.post(api_url, headers=headers, json=data)
+    response = await client.post(api_url, headers=headers, json=data)
     if response.status_code in [201, 422]:  # 422 if already exists
-        print("✅ Repo creation response:", response.status_code)
-        return f"https://github.com/{os.getenv('GITHUB_USERNAME')}/{repo_name}"
+        logger.info("✅ Repo creation response: %s", response.status_code)
+        return f"https://github.com/{_GITHUB_USERNAME}/{repo_name}"
     raise Exception(f"Failed to create repo: {response.text}")
 
 
-def push_to_github(repo_url, gh_token, folder):
-    """Commit and push files from folder to GitHub repo.
-    Works for both new git init or freshly cloned repo.
-    """
-    # Initialize git repo if missing
-    if not os.path.isdir(os.path.join(folder, ".git")):
-        subprocess.run(["git", "init"], cwd=folder, check=True)
-
-    # Always set user info
-    subprocess.run(
-        ["git", "config", "user.email", "llm-bot@aiexample.com"], cwd=folder, check=True
-    )
-    subprocess.run(["git", "config", "user.name", "llm-bot"], cwd=folder, check=True)
+def _commit_and_push(repo_url, gh_token, folder):
+    if os.path.isdir(os.path.join(folder, ".git")):
+        repo = pygit2.Repository(folder)
+    else:
+        repo = pygit2.init_repository(folder, initial_head="main")
 
     # Stage changes
-    subprocess.run(["git", "add", "."], cwd=folder, check=True)
+    repo.index.add_all()
+    repo.index.write()
+    tree = repo.index.write_tree()
 
     # Only commit if there are changes
-    status = subprocess.run(
-        ["git", "status", "--porcelain"],
-        cwd=folder,
-        capture_output=True,
-        text=True,
-    )
-    if status.stdout.strip():
-        subprocess.run(
-            ["git", "commit", "-m", "Automated commit"], cwd=folder, check=True
+    parents = [] if repo.head_is_unborn else [repo.head.target]
+    if parents and repo.head.peel(pygit2.Commit).tree_id == tree:
+        logger.info("ℹ️ No changes to commit; skipping git commit.")
+    else:
+        sig = pygit2.Signature("llm-bot", "llm-bot@aiexample.com")
+        repo.create_commit(
+            "refs/heads/main", sig, sig, "Automated commit", tree, parents
         )
+    repo.set_head("refs/heads/main")
+
+    # Point origin at the repo; the token is passed as credentials, not in the URL
+    if "origin" in repo.remotes.names():
+        repo.remotes.set_url("origin", repo_url)
     else:
-        print("ℹ️ No changes to commit; skipping git commit.")
+        repo.remotes.create("origin", repo_url)
+    callbacks = pygit2.RemoteCallbacks(
+        credentials=pygit2.UserPass(gh_token, "x-oauth-basic")
+    )
+    repo.remotes["origin"].push(
+        ["+refs/heads/main:refs/heads/main"], callbacks=callbacks
+    )
 
-    repo_url_with_token = repo_url.replace("https://", f"https://{gh_token}@")
+    return str(repo.head.target)
 
-    # Try to set-url; if it fails, add remote origin
-    try:
-        subprocess.run(
-            ["git", "remote", "set-url", "origin", repo_url_with_token],
-            cwd=folder,
-            check=True,
-        )
-    except subprocess.CalledProcessError:
-        subprocess.run(
-            ["git", "remote", "add", "origin", repo_url_with_token],
-            cwd=folder,
-            check=True,
-        )
 
-    subprocess.run(["git", "branch", "-M", "main"], cwd=folder, check=True)
-    subprocess.run(
-        ["git", "push", "-u", "origin", "main", "--force"], cwd=folder, check=True
-    )
+async def push_to_github(repo_url, gh_token, folder):
+    """Commit and push files from folder to GitHub repo.
+    Works on a new folder (initialised here) or an existing persistent workdir.
+    Runs in-process through libgit2 instead of spawning a git binary per step.
+    """
+    return await asyncio.to_thread(_commit_and_push, repo_url, gh_token, folder)
 
-    # Get latest commit SHA
-    sha = (
-        subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=folder)
-        .decode()
-        .strip()
-    )
-    return sha
+
+async def write_file(path, text):
+    """Write text as UTF-8 from a worker thread so disk I/O stays off the event loop."""
+    await asyncio.to_thread(Path(path).write_bytes, text.encode("utf-8"))
 
 
-def generate_readme(brief, checks, task_id):
+def generate_readme(brief, checks_md, task_id):
+    """checks_md is the checks already rendered as a markdown bullet list."""
     return f"""# {task_id}
 
 ## Overview
@@ -163,7 +296,7 @@ This project is a single-page app generated for the brief:
 > {brief}
 
 ## Checks Implemented
-{chr(10).join("- " + c for c in checks)}
+{checks_md}
 
 ## Usage
 Open `index.html` in your browser. All required logic, CSS and JS are included in this file.
@@ -174,26 +307,4 @@ MIT
 
 
 def generate_mit_license(author):
-    year = datetime.now().year
-    return f"""MIT License
-
-Copyright (c) {year} {author}
-
-Permission is hereby granted, free of charge, to any person obtaining a copy
-of this software and associated documentation files (the "Software"), to deal
-in the Software without restriction, including without limitation the rights
-to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
-copies of the Software, and to permit persons to whom the Software is
-furnished to do so, subject to the following conditions:
-
-The above copyright notice and this permission notice shall be included in
-all copies or substantial portions of the Software.
-
-THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
-IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
-FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
-AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
-LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
-OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
-SOFTWARE.
-"""
+    return _LICENSE_TEMPLATE.format(year=_CURRENT_YEAR, author=author)